@@ -2,10 +2,12 @@
 Streamlit app: Gemini-2.5-flash travel planner chatbot
 Features:
 - Uses google-genai python client to call gemini-2.5-flash
-- Reads GEMINI_API_KEY from Streamlit secrets (st.secrets["GEMINI_API_KEY"]) and sets it into the environment
+- Reads GEMINI_API_KEY from Streamlit secrets (st.secrets["GEMINI_API_KEY"]) and passes it to the client
 - Conversation UI: input box + history display
+- Chat history is saved to a local SQLite file (history.db), so a page refresh keeps the conversation
 - Asks travel questions (budget, travel style, duration, people) and generates an itinerary
 - Attempts streaming responses; falls back to non-streaming if streaming isn't available
+- Keeps a Gemini chat session per browser session, so follow-up messages keep their context
 
 How to run:
 1) pip install streamlit google-genai
@@ -21,10 +23,18 @@ Run:
 
 """
 
-import os
+import asyncio
+import itertools
+import queue
+import random
+import re
+import sqlite3
+import threading
+import uuid
+import numpy as np
 import streamlit as st
 from google import genai
-from google.genai import types
+from google.genai import errors, types
 import time
 
 # ----------------------
@@ -37,26 +47,382 @@ if "GEMINI_API_KEY" not in st.secrets:
     st.error("GEMINI_API_KEY not found in Streamlit secrets. Add it to .streamlit/secrets.toml as GEMINI_API_KEY = \"...\"")
     st.stop()
 
-# Put the key into environment so google-genai client picks it up
-os.environ["GEMINI_API_KEY"] = st.secrets["GEMINI_API_KEY"]
+@st.cache_resource
+def get_client():
+    # Create GenAI client once per process, passing the key directly instead of via os.environ
+    return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
 
-# Create GenAI client (will use GEMINI_API_KEY from env)
-client = genai.Client()
+
+@st.cache_resource
+def get_async_loop():
+    # One long-lived event loop in a background thread. client.aio is only ever used on this loop,
+    # so its pooled async connections stay bound to the loop they were opened on
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+client = get_client()
+async_loop = get_async_loop()
 MODEL_NAME = "gemini-2.5-flash"
+EMBED_MODEL_NAME = "text-embedding-004"
+
+# Semantic response cache: answers are reused when a new prompt is this similar to a cached one
+CACHE_SIMILARITY = 0.93
+CACHE_MAX_ENTRIES = 64
+CACHE_MIN_PROMPT_CHARS = 20
+
+# Streaming output is handed to st.write_stream once this many new characters or seconds have accumulated
+STREAM_FLUSH_CHARS = 32
+STREAM_FLUSH_SECONDS = 0.05
+# Chunks longer than this are typed out in small slices over at most STREAM_SMOOTH_MAX_SECONDS,
+# unless the next chunk arrives first
+STREAM_SMOOTH_OVER_CHARS = 50
+STREAM_SMOOTH_SLICE_CHARS = 4
+STREAM_SMOOTH_DELAY_SECONDS = 0.02
+STREAM_SMOOTH_MAX_SECONDS = 0.5
+# How long the script thread waits on the background stream before checking for a pending flush
+STREAM_POLL_SECONDS = 0.05
+
+# Once the chat session holds more than HISTORY_MAX_MESSAGES, the older ones are summarized in the
+# background and only the last HISTORY_KEEP_MESSAGES are sent verbatim alongside the summary
+HISTORY_MAX_MESSAGES = 20
+HISTORY_KEEP_MESSAGES = 10
+# Rate-limited / overloaded model calls are retried with exponential backoff plus jitter
+RETRY_ATTEMPTS = 4
+RETRY_STATUS_CODES = (429, 503)
+RETRY_BASE_DELAY_SECONDS = 0.25
+RETRY_MAX_DELAY_SECONDS = 8
+RETRY_JITTER_SECONDS = 0.1
+SUMMARY_PROMPT = "Summarize this travel-planning conversation concisely, keeping every trip detail and decision the user gave:\n"
+
+# Chat history is persisted here, keyed by the "sid" query parameter of the browser session
+DB_PATH = "history.db"
+SQL_LOAD_MESSAGES = "SELECT idx, role, text FROM msg WHERE sid = ? ORDER BY idx"
+SQL_SAVE_MESSAGE = "INSERT OR REPLACE INTO msg (sid, idx, role, text) VALUES (?, ?, ?, ?)"
+SQL_CLEAR_MESSAGES = "DELETE FROM msg WHERE sid = ?"
+
+
+@st.cache_resource
+def get_db():
+    con = sqlite3.connect(DB_PATH, check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("CREATE TABLE IF NOT EXISTS msg (sid TEXT, idx INTEGER, role TEXT, text TEXT, PRIMARY KEY (sid, idx))")
+    # Every session thread shares this connection, so each statement and its commit runs under the lock
+    return con, threading.Lock()
+
+
+db, db_lock = get_db()
 
 # ----------------------
 # Helpers
 # ----------------------
 
 def ensure_session():
-    if "history" not in st.session_state:
-        st.session_state.history = []  # list of (role, text)
+    if "sid" not in st.session_state:
+        # Keep the session id in the URL so a refresh picks the same history back up
+        if "sid" not in st.query_params:
+            st.query_params["sid"] = uuid.uuid4().hex
+        st.session_state.sid = st.query_params["sid"]
+    if "roles" not in st.session_state:
+        # history kept as parallel lists: roles[i] is the speaker of texts[i]
+        with db_lock:
+            rows = db.execute(SQL_LOAD_MESSAGES, (st.session_state.sid,)).fetchall()
+        # New rows continue after the highest stored idx, even if the trailing row is dropped below
+        st.session_state.next_row_id = rows[-1][0] + 1 if rows else 0
+        # An empty trailing reply was never finished; drop it so the user turn before it is answered
+        if rows and rows[-1][1] == "assistant" and not rows[-1][2]:
+            rows.pop()
+        # row_ids[i] is the DB idx of message i; it need not equal i (a reply may still be unsaved)
+        st.session_state.row_ids = [idx for idx, _, _ in rows]
+        st.session_state.roles = [role for _, role, _ in rows]
+        st.session_state.texts = [text for _, _, text in rows]
     if "user_profile" not in st.session_state:
         st.session_state.user_profile = {}
+    if "chat" not in st.session_state:
+        # Completed turns only; a trailing user message is sent as the next turn
+        done = len(st.session_state.roles)
+        if done and st.session_state.roles[-1] == "user":
+            done -= 1
+        st.session_state.chat = new_chat([
+            make_content(role, text)
+            for role, text in zip(st.session_state.roles[:done], st.session_state.texts[:done])
+        ] or None)
+    if "resp_cache" not in st.session_state:
+        # vectors are rows of one float32 matrix (normalized), contexts and texts are the matching
+        # conversation keys and responses
+        st.session_state.resp_cache = {"vectors": None, "contexts": [], "texts": []}
+
+
+def add_message(role, text, save=True):
+    # The DB idx is reserved now, so an unsaved reply keeps its place before later messages
+    st.session_state.row_ids.append(st.session_state.next_row_id)
+    st.session_state.next_row_id += 1
+    st.session_state.roles.append(role)
+    st.session_state.texts.append(text)
+    if save:
+        save_message(len(st.session_state.roles) - 1)
+
+
+def save_message(pos):
+    row = (st.session_state.sid, st.session_state.row_ids[pos], st.session_state.roles[pos], st.session_state.texts[pos])
+    with db_lock, db:
+        db.execute(SQL_SAVE_MESSAGE, row)
+
+
+def clear_messages():
+    st.session_state.row_ids = []
+    st.session_state.next_row_id = 0
+    st.session_state.roles = []
+    st.session_state.texts = []
+    st.session_state.history_summary = ""
+    st.session_state.resp_cache = {"vectors": None, "contexts": [], "texts": []}
+    st.session_state.pop("summary_job", None)
+    # a reply still streaming belongs to the cleared conversation
+    st.session_state.pop("stream_job", None)
+    with db_lock, db:
+        db.execute(SQL_CLEAR_MESSAGES, (st.session_state.sid,))
+
+
+def make_content(role, text):
+    return types.Content(role="user" if role == "user" else "model", parts=[types.Part.from_text(text=text)])
+
+
+def content_text(content):
+    return "".join(part.text or "" for part in content.parts or [])
+
 
+def chat_config():
+    summary = st.session_state.get("history_summary")
+    if not summary:
+        return CHAT_CONFIG
+    return types.GenerateContentConfig(
+        system_instruction=f"{SYSTEM_PROMPT}\n\nSummary of the earlier conversation:\n{summary}"
+    )
 
-def add_message(role, text):
-    st.session_state.history.append((role, text))
+
+def new_chat(history=None):
+    # Chat session keeps prior turns, so each request only adds the new user message
+    return client.chats.create(model=MODEL_NAME, config=chat_config(), history=history)
+
+
+def is_retryable(e):
+    return isinstance(e, errors.APIError) and e.code in RETRY_STATUS_CODES
+
+
+def retry_delay(attempt):
+    delay = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt)
+    return delay + random.random() * RETRY_JITTER_SECONDS
+
+
+def call_with_retry(fn):
+    # For background threads, where a blocking sleep between attempts holds up nothing else
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return fn()
+        except Exception as e:
+            if not is_retryable(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            time.sleep(retry_delay(attempt))
+
+
+async def send_with_retry(achat, message):
+    # Same chat and message on every attempt, so nothing is rebuilt between retries
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await achat.send_message(message)
+        except Exception as e:
+            if not is_retryable(e) or attempt == RETRY_ATTEMPTS - 1:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+
+
+def summarize_history(job):
+    # Runs in a background thread; a failed summary leaves the history as is until the next try
+    try:
+        resp = call_with_retry(lambda: client.models.generate_content(model=MODEL_NAME, contents=job["prompt"]))
+        job["summary"] = resp.text or ""
+    except Exception:
+        job["summary"] = ""
+    job["done"] = True
+
+
+def maybe_start_summary(chat):
+    if "summary_job" in st.session_state:
+        return
+    history = chat.get_history()
+    if len(history) <= HISTORY_MAX_MESSAGES:
+        return
+    # The kept window starts at a user turn
+    cut = len(history) - HISTORY_KEEP_MESSAGES
+    while cut < len(history) and history[cut].role != "user":
+        cut += 1
+    lines = []
+    if st.session_state.get("history_summary"):
+        lines.append(f"Earlier summary: {st.session_state.history_summary}")
+    lines.extend(f"{content.role}: {content_text(content)}" for content in history[:cut])
+    job = {"prompt": SUMMARY_PROMPT + "\n".join(lines), "cut": cut, "summary": "", "done": False}
+    st.session_state.summary_job = job
+    threading.Thread(target=summarize_history, args=(job,), daemon=True).start()
+
+
+def apply_summary():
+    # Swap the summarized messages out of the chat session once the background summary is ready
+    job = st.session_state.get("summary_job")
+    if job is None or not job["done"]:
+        return
+    del st.session_state["summary_job"]
+    if job["summary"]:
+        st.session_state.history_summary = job["summary"]
+        st.session_state.chat = new_chat(st.session_state.chat.get_history()[job["cut"]:])
+
+
+def chunk_text_extractor(chunk):
+    # depending on client, chunk may be a dict or object with .text; the type is the same for
+    # every chunk of a stream, so the check runs once on the first chunk
+    if hasattr(chunk, "text"):
+        return lambda c: c.text or ""
+    if isinstance(chunk, dict) and "text" in chunk:
+        return lambda c: c["text"]
+    return str
+
+
+def open_stream(chat, prompt):
+    # A rate limit surfaces when the first chunk is requested, before any text has been shown,
+    # so until then the whole request can be retried
+    def attempt():
+        stream = iter(chat.send_message_stream(prompt))
+        return stream, next(stream, None)
+
+    return call_with_retry(attempt)
+
+
+def consume_stream(chat, prompt, q):
+    # Runs in a background thread: pushes text pieces, then any error, then None when done
+    try:
+        stream, first = open_stream(chat, prompt)
+        extract = chunk_text_extractor(first)
+        for chunk in itertools.chain([first] if first is not None else [], stream):
+            q.put(extract(chunk))
+    except Exception as e:
+        q.put(e)
+    q.put(None)
+
+
+def start_stream_job(chat, prompt, idx, prompt_vec, context):
+    # Kept in session state so a rerun in the middle of a reply re-attaches instead of losing it
+    q = queue.Queue()
+    thread = threading.Thread(target=consume_stream, args=(chat, prompt, q), daemon=True)
+    job = {"prompt": prompt, "idx": idx, "prompt_vec": prompt_vec, "context": context, "queue": q, "thread": thread, "buf": []}
+    st.session_state.stream_job = job
+    thread.start()
+    return job
+
+
+def smooth_piece(piece, q):
+    # Types out an oversized chunk in small slices, but only while nothing else is waiting:
+    # as soon as the next chunk has arrived the rest is released at once, so the reply is never delayed
+    slices = range(0, len(piece), STREAM_SMOOTH_SLICE_CHARS)
+    delay = min(STREAM_SMOOTH_DELAY_SECONDS, STREAM_SMOOTH_MAX_SECONDS / len(slices))
+    for start in slices:
+        if start:
+            if q.empty():
+                time.sleep(delay)
+            if not q.empty():
+                yield piece[start:]
+                return
+        yield piece[start:start + STREAM_SMOOTH_SLICE_CHARS]
+
+
+def stream_pieces(job):
+    # Generator for st.write_stream: yields the reply in batches instead of one render per piece.
+    # Every piece is also kept in job["buf"], so a re-attached stream starts from what was already received.
+    q = job["queue"]
+    buf = job["buf"]
+    if buf:
+        yield "".join(buf)
+    pending = []
+    pending_len = 0
+    last_flush_ts = time.monotonic()
+    while True:
+        try:
+            piece = q.get(timeout=STREAM_POLL_SECONDS)
+        except queue.Empty:
+            # The consumer always ends with None unless its thread died; don't wait on it forever
+            if not job["thread"].is_alive() and q.empty():
+                raise RuntimeError("The response stream stopped before it finished.")
+            # nothing new yet; still flush anything that arrived since the last render
+            piece = ""
+        if piece is None:
+            break
+        if isinstance(piece, Exception):
+            raise piece
+        if len(piece) > STREAM_SMOOTH_OVER_CHARS:
+            buf.append(piece)
+            if pending:
+                yield "".join(pending)
+                pending = []
+                pending_len = 0
+            yield from smooth_piece(piece, q)
+            last_flush_ts = time.monotonic()
+            continue
+        if piece:
+            buf.append(piece)
+            pending.append(piece)
+            pending_len += len(piece)
+        now = time.monotonic()
+        if pending and (pending_len > STREAM_FLUSH_CHARS or now - last_flush_ts > STREAM_FLUSH_SECONDS):
+            yield "".join(pending)
+            pending = []
+            pending_len = 0
+            last_flush_ts = now
+    if pending:
+        yield "".join(pending)
+
+
+def embed_text(text):
+    resp = client.models.embed_content(model=EMBED_MODEL_NAME, contents=text)
+    vec = np.asarray(resp.embeddings[0].values, dtype=np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def cache_context(prompt):
+    # A cached answer is only reused for the same saved trip details, the same summary of earlier
+    # turns and the same numbers in the prompt, so "Nights: 3" never matches "Nights: 4"
+    profile = tuple(sorted(st.session_state.user_profile.items()))
+    return hash((profile, st.session_state.get("history_summary", ""), tuple(re.findall(r"\d+", prompt))))
+
+
+def cache_lookup(vec, context):
+    cache = st.session_state.resp_cache
+    rows = [i for i, c in enumerate(cache["contexts"]) if c == context]
+    if not rows:
+        return None
+    # Vectors are normalized, so the dot product is the cosine similarity
+    scores = cache["vectors"][rows] @ vec
+    best = rows[int(np.argmax(scores))]
+    if scores.max() < CACHE_SIMILARITY:
+        return None
+    # Move the hit to the end so the least recently used entry is evicted first
+    cache["contexts"].append(cache["contexts"].pop(best))
+    text = cache["texts"].pop(best)
+    cache["texts"].append(text)
+    cache["vectors"] = np.vstack([np.delete(cache["vectors"], best, axis=0), cache["vectors"][best]])
+    return text
+
+
+def cache_store(vec, context, text):
+    cache = st.session_state.resp_cache
+    if cache["vectors"] is None:
+        cache["vectors"] = vec[np.newaxis, :]
+    else:
+        cache["vectors"] = np.vstack([cache["vectors"], vec])
+    cache["contexts"].append(context)
+    cache["texts"].append(text)
+    if len(cache["texts"]) > CACHE_MAX_ENTRIES:
+        cache["vectors"] = cache["vectors"][1:]
+        cache["contexts"].pop(0)
+        cache["texts"].pop(0)
 
 
 # Build a system prompt that instructs the model to act as a travel planner
@@ -67,6 +433,30 @@ SYSTEM_PROMPT = (
     "Be concise and present the final itinerary as numbered days with bullet points."
 )
 
+# "Plan full itinerary now" prompt: each saved profile field fills one line of the template
+PLAN_PROMPT_TEMPLATE = (
+    "Please create a travel plan.\n"
+    "{fields}"
+    "If any information is missing, ask a short clarifying question before producing the full itinerary."
+)
+PLAN_PROMPT_FIELDS = (
+    ("destination", "Destination: {}\n"),
+    ("nights", "Nights: {}\n"),
+    ("people", "People: {}\n"),
+    ("budget", "Budget: {}\n"),
+    ("travel_style", "Travel style: {}\n"),
+)
+
+
+def compose_plan_prompt(profile):
+    # 0 nights is a valid answer, so only missing or empty values are skipped
+    fields = "".join(fmt.format(profile[key]) for key, fmt in PLAN_PROMPT_FIELDS if profile.get(key) not in (None, ""))
+    return PLAN_PROMPT_TEMPLATE.format(fields=fields)
+
+
+# System prompt is passed as system_instruction instead of being re-sent as a user turn
+CHAT_CONFIG = types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
+
 # ----------------------
 # UI layout
 # ----------------------
@@ -113,111 +503,128 @@ with left:
     col1, col2 = st.columns(2)
     if col1.button("Plan full itinerary now"):
         # Compose a prompt that instructs the model to use saved profile data
-        profile = st.session_state.user_profile
-        prompt_parts = ["Please create a travel plan."]
-        if profile.get("destination"):
-            prompt_parts.append(f"Destination: {profile['destination']}")
-        if profile.get("nights") is not None:
-            prompt_parts.append(f"Nights: {profile['nights']}")
-        if profile.get("people"):
-            prompt_parts.append(f"People: {profile['people']}")
-        if profile.get("budget"):
-            prompt_parts.append(f"Budget: {profile['budget']}")
-        if profile.get("travel_style"):
-            prompt_parts.append(f"Travel style: {profile['travel_style']}")
-        prompt_parts.append("If any information is missing, ask a short clarifying question before producing the full itinerary.")
-        composed = "\n".join(prompt_parts)
-        add_message("user", composed)
+        add_message("user", compose_plan_prompt(st.session_state.user_profile))
 
     if col2.button("Clear chat"):
-        st.session_state.history = []
+        clear_messages()
+        st.session_state.chat = new_chat()
         st.success("Chat cleared.")
 
 with right:
     st.subheader("Conversation")
     box = st.container()
 
-    # Display history
+    # Display history; a reply still streaming from an earlier run gets its bubble in its own place,
+    # ahead of any message sent while it streamed
+    job = st.session_state.get("stream_job")
+    stream_placeholder = None
     with box:
-        for role, text in st.session_state.history:
+        for i, (role, text) in enumerate(zip(st.session_state.roles, st.session_state.texts)):
             if role == "system":
                 st.info(f"SYSTEM: {text}")
-            elif role == "user":
-                st.markdown(f"**You:** {text}")
-            else:
-                st.markdown(f"**Assistant:** {text}")
+            elif job is not None and i == job["idx"]:
+                with st.chat_message("assistant"):
+                    stream_placeholder = st.empty()
+            elif text:
+                with st.chat_message("user" if role == "user" else "assistant"):
+                    st.markdown(text)
 
 # ----------------------
 # If there is a new user message in the last item, call the model
+# (or, if a rerun interrupted the previous reply, pick its stream back up)
 # ----------------------
-if len(st.session_state.history) > 0 and st.session_state.history[-1][0] == "user":
-    latest_user = st.session_state.history[-1][1]
-
-    # Build conversation formatted for Gemini (we'll send system then user)
-    contents = [
-        {"parts": [{"text": SYSTEM_PROMPT}]},
-        {"parts": [{"text": latest_user}]},
-    ]
-
-    # Insert a placeholder assistant message to be replaced by streaming content
-    add_message("assistant", "")
-
-    # Stream the response if possible
-    assistant_text = ""
-    streamed = False
-    stream_placeholder = st.empty()
-
-    try:
-        # Attempt streaming API
-        stream = None
-        # The google-genai library naming for streaming may vary across versions; try common names in order.
-        if hasattr(client.models, "generate_content_stream"):
-            stream = client.models.generate_content_stream(model=MODEL_NAME, contents=contents)
-        elif hasattr(client.models, "generate_content_streaming"):
-            stream = client.models.generate_content_streaming(model=MODEL_NAME, contents=contents)
-        elif hasattr(client.models, "stream_generate_content"):
-            stream = client.models.stream_generate_content(model=MODEL_NAME, contents=contents)
-        elif hasattr(client.models, "stream_generate"):
-            stream = client.models.stream_generate(model=MODEL_NAME, contents=contents)
-
-        if stream is not None:
-            streamed = True
-            for chunk in stream:
-                # depending on client, chunk may be a dict or object with .text
-                if hasattr(chunk, "text"):
-                    piece = chunk.text
-                elif isinstance(chunk, dict) and "text" in chunk:
-                    piece = chunk["text"]
-                else:
-                    piece = str(chunk)
-                assistant_text += piece
-                # update live UI (replace the placeholder assistant message)
-                st.session_state.history[-1] = ("assistant", assistant_text)
-                stream_placeholder.markdown(f"**Assistant (streaming):** {assistant_text}")
-            # after streaming completes, no-op
-    except Exception as e:
-        # Streaming not available or failed; we'll fall back to non-streaming below
-        st.warning(f"Streaming failed or not supported in this environment: {e}")
-        streamed = False
-
-    if not streamed:
+if job is not None or (st.session_state.roles and st.session_state.roles[-1] == "user"):
+    if job is None:
+        apply_summary()
+    chat = st.session_state.chat
+    failed = False
+    if stream_placeholder is None:
+        with box:
+            with st.chat_message("assistant"):
+                stream_placeholder = st.empty()
+
+    if job is None:
+        latest_user = st.session_state.texts[-1]
+        # Insert a placeholder assistant message to be replaced by streaming content;
+        # it is saved only once the reply is final, so a refresh mid-reply re-sends the user turn
+        add_message("assistant", "", save=False)
+        reply_idx = len(st.session_state.roles) - 1
+
+        # Serve repeat / near-repeat prompts from the semantic response cache
+        prompt_vec = None
+        cached = None
+        context = cache_context(latest_user)
+        # Short follow-ups ("yes", "make it cheaper") only make sense in their context, so they skip
+        # the cache and its embedding call entirely
+        if len(latest_user) >= CACHE_MIN_PROMPT_CHARS:
+            try:
+                prompt_vec = embed_text(latest_user)
+                cached = cache_lookup(prompt_vec, context)
+            except Exception:
+                # The cache is best-effort; an embedding failure just means a normal model call
+                prompt_vec = None
+
+        if cached is not None:
+            st.session_state.texts[reply_idx] = cached
+            # Keep the chat session in step with what the user sees
+            st.session_state.chat = new_chat(chat.get_history() + [
+                make_content("user", latest_user),
+                make_content("assistant", cached),
+            ])
+        else:
+            # Stream the response in the background; only the new user turn is added to the chat session
+            job = start_stream_job(chat, latest_user, reply_idx, prompt_vec, context)
+    else:
+        latest_user = job["prompt"]
+        reply_idx = job["idx"]
+        prompt_vec = job["prompt_vec"]
+        context = job["context"]
+
+    if job is not None:
         try:
-            # Non-streaming call
-            resp = client.models.generate_content(model=MODEL_NAME, contents=contents)
-            # resp.text is the convenient helper from quickstart
-            text = getattr(resp, "text", None) or str(resp)
-            assistant_text = text
-            st.session_state.history[-1] = ("assistant", assistant_text)
+            stream_placeholder.write_stream(stream_pieces(job))
+            assistant_text = "".join(job["buf"])
         except Exception as e:
-            # Provide user-friendly error
-            err_msg = f"Error calling Gemini API: {e}. Check your API key and network."
-            st.session_state.history[-1] = ("assistant", err_msg)
-
-    # final rendering
-    st.experimental_rerun()
+            # Streaming not available or failed; we'll fall back to non-streaming below
+            if is_retryable(e):
+                st.warning(f"Gemini is busy or rate-limiting requests ({e.code}); retrying without streaming.")
+            else:
+                st.warning(f"Streaming failed or not supported in this environment: {e}")
+            assistant_text = None
+        del st.session_state["stream_job"]
+
+        if assistant_text is None:
+            try:
+                # Non-streaming call through the async client, continuing from the same chat history;
+                # config and history are read here because session state belongs to the script thread
+                async def _run(config, history):
+                    achat = client.aio.chats.create(model=MODEL_NAME, config=config, history=history)
+                    return achat, await send_with_retry(achat, latest_user)
+
+                achat, resp = asyncio.run_coroutine_threadsafe(
+                    _run(chat_config(), chat.get_history()), async_loop
+                ).result()
+                st.session_state.chat = new_chat(achat.get_history())
+                # resp.text is the convenient helper from quickstart
+                assistant_text = getattr(resp, "text", None) or str(resp)
+            except Exception as e:
+                # Provide user-friendly error
+                assistant_text = f"Error calling Gemini API: {e}. Check your API key and network."
+                failed = True
+        st.session_state.texts[reply_idx] = assistant_text
+        if prompt_vec is not None and not failed:
+            cache_store(prompt_vec, context, assistant_text)
+
+    save_message(reply_idx)
+    maybe_start_summary(st.session_state.chat)
+
+    # final rendering, in place; the next rerun draws it from history like any other message
+    stream_placeholder.markdown(st.session_state.texts[reply_idx])
+
+    # A message sent while this reply was still streaming gets its own turn
+    if st.session_state.roles[-1] == "user":
+        st.rerun()
 
 # ----------------------
 # End of file
 # ----------------------
-
-